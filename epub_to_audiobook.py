@@ -3,16 +3,23 @@ import re
 import io
 import argparse
 import html
-import ebooklib
-from ebooklib import epub
-from bs4 import BeautifulSoup
+import codecs
+import hashlib
+import json
+import posixpath
+import zipfile
+from urllib.parse import unquote
+from lxml import etree
 import requests
-from typing import List, Tuple
-from datetime import datetime, timedelta
-from mutagen.mp3 import MP3
-from mutagen.id3 import TIT2, TPE1, TALB, TRCK
+from requests.adapters import HTTPAdapter
+from typing import List, Tuple, Optional, Iterator
+from datetime import datetime, timedelta, timezone
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, TRCK
 import logging
-from time import sleep
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from time import sleep, monotonic
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s [%(levelname)s] %(message)s',
@@ -22,6 +29,28 @@ logger = logging.getLogger(__name__)
 # Added max_retries constant
 MAX_RETRIES = 10
 
+# Set when the conversion is aborting, so that worker threads stop at their
+# next request or retry instead of finishing their chapter first
+_shutdown = threading.Event()
+# The error that started the abort. Workers stopped by it raise
+# CancelledError, which must not be reported in its place
+_shutdown_error: Optional[BaseException] = None
+_shutdown_lock = threading.Lock()
+
+
+def abort_conversion(error: BaseException) -> None:
+    global _shutdown_error
+    with _shutdown_lock:
+        if _shutdown_error is None and not isinstance(error, CancelledError):
+            _shutdown_error = error
+    _shutdown.set()
+
+# Azure tokens are valid for 10 minutes
+ACCESS_TOKEN_LIFETIME = timedelta(minutes=10)
+# Renew tokens this many seconds early so a token never expires while a long
+# chunk is still being synthesized
+TOKEN_REFRESH_MARGIN = 60
+
 
 subscription_key = os.environ.get("MS_TTS_KEY")
 region = os.environ.get("MS_TTS_REGION")
@@ -36,58 +65,222 @@ TOKEN_HEADERS = {
 }
 
 TTS_URL = f"https://{region}.tts.speech.microsoft.com/cognitiveservices/v1"
+OUTPUT_FORMAT = "audio-24khz-48kbitrate-mono-mp3"
+
+# Tokens are cached on disk so that runs started within a token's lifetime
+# skip the issuetoken round-trip. The file name is derived from the key and
+# region, so a token is never reused for a different Speech resource
+TOKEN_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"),
+    "epub_to_audiobook",
+    "azure_token_" + hashlib.sha256(f"{region}:{subscription_key}".encode('utf-8')).hexdigest()[:16] + ".json")
+
+
+TITLE_PUNCTUATION_RE = re.compile(r"[^\w\s]", flags=re.UNICODE)
+TITLE_WHITESPACE_RE = re.compile(r"\s")
 
 
 def sanitize_title(title: str) -> str:
-    sanitized_title = re.sub(r"[^\w\s]", "", title, flags=re.UNICODE)
-    sanitized_title = re.sub(r"\s", "_", sanitized_title.strip())
+    sanitized_title = TITLE_PUNCTUATION_RE.sub("", title)
+    sanitized_title = TITLE_WHITESPACE_RE.sub("_", sanitized_title.strip())
     return sanitized_title
 
 
-def extract_chapters(epub_book: ebooklib.epub.EpubBook) -> List[Tuple[str, str]]:
-    chapters = []
-    for item in epub_book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            content = item.get_content()
-            soup = BeautifulSoup(content, 'lxml')
-            title = soup.title.string if soup.title else ''
-            raw = soup.get_text(strip=False)
-            logger.info(f"Raw text: <{raw[:100]}>")
-            text = soup.get_text(separator=" ", strip=True)
-            logger.info(f"Stripped text: <{text[:100]}>")
-            chapters.append((title, text))
-            soup.decompose()
-    return chapters
+# EPUB content documents must be UTF-8 or UTF-16, so don't let libxml2 guess
+HTML_PARSER = etree.HTMLParser(encoding="utf-8")
+
+# Small documents are often cover or separator pages whose body holds only
+# images. They yield no text either way, but a regex can tell without
+# building a tree. Anything the regex can't rule out is parsed as usual
+SNIFF_MAX_SIZE = 4096
+BODY_RE = re.compile(rb"<body[\s>].*", flags=re.DOTALL | re.IGNORECASE)
+TAG_RE = re.compile(rb"<[^>]*>")
+
+
+def parse_html(content: bytes) -> Optional[etree._Element]:
+    if content.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        content = content.decode("utf-16").encode("utf-8")
+    if not content.strip():
+        return None
+    if len(content) <= SNIFF_MAX_SIZE:
+        body = BODY_RE.search(content)
+        if body is not None and not TAG_RE.sub(b"", body.group()).strip():
+            return None
+    return etree.fromstring(content, HTML_PARSER)
+
+
+def read_package_document(epub_zip: zipfile.ZipFile) -> Tuple[str, etree._Element]:
+    # META-INF/container.xml points at the OPF package document, which holds
+    # the book's metadata and the manifest of its files
+    container = etree.fromstring(epub_zip.read("META-INF/container.xml"))
+    opf_path = container.find(".//{*}rootfile").get("full-path")
+    return opf_path, etree.fromstring(epub_zip.read(opf_path))
+
+
+def read_book_metadata(input_file: str) -> Tuple[str, str]:
+    with zipfile.ZipFile(input_file) as epub_zip:
+        _, package = read_package_document(epub_zip)
+    # Get the book title and author from metadata or use fallback values
+    book_title = package.findtext("{*}metadata/{*}title") or "Untitled"
+    author = package.findtext("{*}metadata/{*}creator") or "Unknown"
+    return book_title, author
+
+
+def extract_chapters(input_file: str) -> Iterator[str]:
+    # Documents are read from the archive one at a time instead of loading
+    # the whole book into memory up front
+    with zipfile.ZipFile(input_file) as epub_zip:
+        opf_path, package = read_package_document(epub_zip)
+        opf_dir = posixpath.dirname(opf_path)
+        manifest = {item.get("id"): item
+                    for item in package.iterfind("{*}manifest/{*}item")}
+        # The spine lists the documents in reading order
+        for itemref in package.iterfind("{*}spine/{*}itemref"):
+            item = manifest.get(itemref.get("idref"))
+            # XHTML documents, except the EPUB 3 navigation document
+            if item is None or item.get("media-type") != "application/xhtml+xml" or "nav" in item.get("properties", "").split():
+                continue
+            name = posixpath.normpath(posixpath.join(opf_dir, unquote(item.get("href"))))
+            root = parse_html(epub_zip.read(name))
+            if root is None:
+                continue
+            # Only the body is read aloud; <head> usually holds the book title,
+            # which would otherwise open every chapter
+            body = root.find("body")
+            if body is None:
+                continue
+            # Script and style contents are not part of the readable text
+            etree.strip_elements(body, "script", "style", with_tail=False)
+            text = " ".join(filter(None, (s.strip() for s in body.itertext())))
+            logger.debug("Stripped text: <%.100s>", text)
+            # Text nodes are stripped before joining, so this catches
+            # documents with no readable text at all
+            if text:
+                yield text
 
 
 class AccessToken:
     def __init__(self, token: str, expiry_time: datetime):
         self.token = token
+        # expiry_time is kept for the on-disk cache; expiry checks use a
+        # monotonic deadline, which is cheaper and immune to clock changes
         self.expiry_time = expiry_time
-
-    def is_expired(self) -> bool:
-        return datetime.utcnow() >= self.expiry_time
-
-
-def get_access_token() -> AccessToken:
+        self._deadline = monotonic() + \
+            (expiry_time - datetime.utcnow()).total_seconds()
+
+    def is_expired(self, margin: float = 0) -> bool:
+        return monotonic() + margin >= self._deadline
+
+
+class RateLimiter:
+    def __init__(self, requests_per_second: float, burst: int):
+        self.rate = requests_per_second
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        # Token bucket: refill at `rate` per second up to `burst`, and block
+        # until a whole token is available
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+# Spaces out every request sent through it, retries included, so that
+# concurrent workers stay under the service quota instead of hitting 429s
+class RateLimitedAdapter(HTTPAdapter):
+    def __init__(self, rate_limiter: RateLimiter, **kwargs):
+        self.rate_limiter = rate_limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.rate_limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def get_access_token(session: requests.Session) -> AccessToken:
     for retry in range(MAX_RETRIES):
+        if _shutdown.is_set():
+            raise CancelledError()
         try:
-            response = requests.post(TOKEN_URL, headers=TOKEN_HEADERS)
+            # The token's lifetime starts when it is issued, so measure from
+            # before the request rather than after the response
+            expiry_time = datetime.utcnow() + ACCESS_TOKEN_LIFETIME
+            response = session.post(TOKEN_URL, headers=TOKEN_HEADERS)
             response.raise_for_status()
             access_token = str(response.text)
-            expiry_time = datetime.utcnow() + timedelta(minutes=9, seconds=30)
             return AccessToken(access_token, expiry_time)
         except requests.exceptions.RequestException as e:
             if retry < MAX_RETRIES - 1:
                 logger.warning(
                     f"Network error while getting access token (attempt {retry + 1}): {e}")
-                sleep(2 ** retry)
+                _shutdown.wait(2 ** retry)
             else:
                 logger.error(
                     f"Network error while getting access token (attempt {retry + 1}): {e}")
                 raise
 
 
+def load_cached_access_token() -> Optional[AccessToken]:
+    try:
+        with open(TOKEN_CACHE_FILE) as f:
+            cached = json.load(f)
+        access_token = AccessToken(
+            cached["token"], datetime.utcfromtimestamp(cached["expiry_time"]))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return None if access_token.is_expired(_token_refresh_margin) else access_token
+
+
+def save_cached_access_token(access_token: AccessToken) -> None:
+    expiry_time = access_token.expiry_time.replace(tzinfo=timezone.utc)
+    tmp_file = f"{TOKEN_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), exist_ok=True)
+        # The token grants access to the Speech resource, keep it private
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump({"token": access_token.token,
+                       "expiry_time": expiry_time.timestamp()}, f)
+        os.replace(tmp_file, TOKEN_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Failed to cache access token: {e}")
+
+
+# Shared by all chapter workers so that only one of them refreshes the token
+_access_token: Optional[AccessToken] = None
+_access_token_lock = threading.Lock()
+_token_refresh_margin: float = TOKEN_REFRESH_MARGIN
+
+
+def get_valid_access_token(session: requests.Session) -> AccessToken:
+    global _access_token
+    # Fast path: workers only contend on the lock when a refresh is due
+    access_token = _access_token
+    if access_token is not None and not access_token.is_expired(_token_refresh_margin):
+        return access_token
+    with _access_token_lock:
+        if _access_token is None:
+            _access_token = load_cached_access_token()
+        if _access_token is None or _access_token.is_expired(_token_refresh_margin):
+            if _access_token is not None:
+                logger.info(f"access_token is expired, getting new one")
+            _access_token = get_access_token(session)
+            save_cached_access_token(_access_token)
+        return _access_token
+
+
 def split_text(text: str, max_chars: int, language: str) -> List[str]:
     if language.startswith("zh"):
         chunks = [text[i:i + max_chars]
@@ -95,114 +288,227 @@ def split_text(text: str, max_chars: int, language: str) -> List[str]:
     else:
         words = text.split()
         chunks = []
-        current_chunk = ""
+        current_words = []
+        current_len = 0
 
         for word in words:
-            if len(current_chunk) + len(word) + 1 <= max_chars:
-                current_chunk += (" " if current_chunk else "") + word
+            if current_len + len(word) + 1 <= max_chars:
+                current_len += len(word) + (1 if current_words else 0)
+                current_words.append(word)
             else:
-                chunks.append(current_chunk)
-                current_chunk = word
+                chunks.append(" ".join(current_words))
+                current_words = [word]
+                current_len = len(word)
 
-        if current_chunk:
-            chunks.append(current_chunk)
+        if current_words:
+            chunks.append(" ".join(current_words))
 
-    logger.info(f"Split text into {len(chunks)} chunks")
-    for i, chunk in enumerate(chunks, 1):
-        first_100 = chunk[:100]
-        last_100 = chunk[-100:] if len(chunk) > 100 else ""
-        logger.info(
-            f"Chunk {i}: Length={len(chunk)}, Start={first_100}..., End={last_100}")
+    logger.info("Split text into %d chunks", len(chunks))
+    # Per-chunk previews are only built when debug logging is on
+    if logger.isEnabledFor(logging.DEBUG):
+        for i, chunk in enumerate(chunks, 1):
+            logger.debug("Chunk %d: Length=%d, Start=%.100s..., End=%s", i, len(chunk),
+                         chunk, chunk[-100:] if len(chunk) > 100 else "")
 
     return chunks
 
 
-def text_to_speech(session: requests.Session, text: str, output_file: str, voice_name: str, language: str, access_token: AccessToken, title: str, author: str, book_title: str, idx: int) -> AccessToken:
+def synthesize_ssml(session: requests.Session, ssml: str) -> bytes:
+    for retry in range(MAX_RETRIES):
+        if _shutdown.is_set():
+            raise CancelledError()
+        access_token = get_valid_access_token(session)
+        headers = {
+            "Authorization": f"Bearer {access_token.token}",
+            "Content-Type": "application/ssml+xml",
+            "X-Microsoft-OutputFormat": OUTPUT_FORMAT,
+            "User-Agent": "Python"
+        }
+        try:
+            response = session.post(TTS_URL, headers=headers,
+                                    data=ssml.encode('utf-8'))
+            response.raise_for_status()
+            return response.content
+        except requests.exceptions.RequestException as e:
+            if retry < MAX_RETRIES - 1:
+                logger.warning(
+                    f"Network error while converting text to speech (attempt {retry + 1}): {e}")
+                _shutdown.wait(2 ** retry)
+            else:
+                logger.error(
+                    f"Network error while converting text to speech (attempt {retry + 1}): {e}")
+                raise
+
+
+def synthesize_ssml_cached(session: requests.Session, ssml: str, cache_dir: Optional[str]) -> bytes:
+    if not cache_dir:
+        return synthesize_ssml(session, ssml)
+
+    # The SSML carries the voice, language and text, so together with the
+    # output format it fully determines the audio
+    key = hashlib.sha256(f"{OUTPUT_FORMAT}\n{ssml}".encode('utf-8')).hexdigest()
+    cache_file = os.path.join(cache_dir, f"{key}.mp3")
+    try:
+        with open(cache_file, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    audio = synthesize_ssml(session, ssml)
+    # Write under a per-thread name first so that a crash or a concurrent
+    # worker never leaves a truncated entry behind
+    tmp_file = f"{cache_file}.{threading.get_ident()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(audio)
+    os.replace(tmp_file, cache_file)
+    return audio
+
+
+def build_id3_tag(title: str, author: str, book_title: str, idx: int) -> bytes:
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=author))
+    tags.add(TALB(encoding=3, text=book_title))
+    tags.add(TRCK(encoding=3, text=str(idx)))
+    buffer = io.BytesIO()
+    tags.save(buffer)
+    return buffer.getvalue()
+
+
+def text_to_speech(session: requests.Session, text: str, output_file: str, voice_name: str, language: str, title: str, author: str, book_title: str, idx: int, chunk_concurrency: int = 1, cache_dir: Optional[str] = None) -> None:
     # Adjust this value based on your testing
     max_chars = 1800 if language.startswith("zh") else 3000
 
     text_chunks = split_text(text, max_chars, language)
 
-    audio_segments = []
-
-    for i, chunk in enumerate(text_chunks, 1):
-        escaped_text = html.escape(chunk)
-        logger.info(
-            f"Processing chapter-{idx} <{title}>, chunk {i} of {len(text_chunks)}")
-        ssml = f"<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='{language}'><voice name='{voice_name}'>{escaped_text}</voice></speak>"
-
-        for retry in range(MAX_RETRIES):
-            if access_token.is_expired():
-                logger.info(f"access_token is expired, getting new one")
-                access_token = get_access_token()
-            headers = {
-                "Authorization": f"Bearer {access_token.token}",
-                "Content-Type": "application/ssml+xml",
-                "X-Microsoft-OutputFormat": "audio-24khz-48kbitrate-mono-mp3",
-                "User-Agent": "Python"
-            }
-            try:
-                response = session.post(TTS_URL, headers=headers,
-                                        data=ssml.encode('utf-8'))
-                response.raise_for_status()
-                break
-            except requests.exceptions.RequestException as e:
-                if retry < MAX_RETRIES - 1:
-                    logger.warning(
-                        f"Network error while converting text to speech (attempt {retry + 1}): {e}")
-                    sleep(2 ** retry)
-                else:
-                    logger.error(
-                        f"Network error while converting text to speech (attempt {retry + 1}): {e}")
-                    raise
-
-        audio_segments.append(io.BytesIO(response.content))
-
-    with open(output_file, "wb") as outfile:
-        for segment in audio_segments:
-            segment.seek(0)
-            outfile.write(segment.read())
-
-    # Add ID3 tags to the generated MP3 file
-    audio = MP3(output_file)
-    audio["TIT2"] = TIT2(encoding=3, text=title)
-    audio["TPE1"] = TPE1(encoding=3, text=author)
-    audio["TALB"] = TALB(encoding=3, text=book_title)
-    audio["TRCK"] = TRCK(encoding=3, text=str(idx))
-    audio.save()
-    return access_token
-
-
-def epub_to_audiobook(input_file: str, output_folder: str, voice_name: str, language: str) -> None:
-    book = epub.read_epub(input_file)
-    chapters = extract_chapters(book)
+    # Write into a temporary name so an interrupted chapter is never
+    # mistaken for a finished one
+    partial_file = output_file + ".part"
+    ssml_prefix = f"<speak version='1.0' xmlns='http://www.w3.org/2001/10/synthesis' xml:lang='{language}'><voice name='{voice_name}'>"
+    ssml_suffix = "</voice></speak>"
+    with open(partial_file, "wb") as outfile, ThreadPoolExecutor(max_workers=chunk_concurrency) as executor:
+        # Add ID3 tags to the generated MP3 file. The tag is written ahead of
+        # the audio so the finished file never has to be rewritten
+        outfile.write(build_id3_tag(title, author, book_title, idx))
+        # Chunks are synthesized concurrently but written in order; at most
+        # chunk_concurrency requests are in flight at any time
+        futures = deque()
+        try:
+            for i, chunk in enumerate(text_chunks, 1):
+                if len(futures) >= chunk_concurrency:
+                    outfile.write(futures.popleft().result())
+                # Quotes only need escaping inside attributes, not in element text
+                escaped_text = html.escape(chunk, quote=False)
+                logger.info("Processing chapter-%d <%s>, chunk %d of %d",
+                            idx, title, i, len(text_chunks))
+                ssml = ssml_prefix + escaped_text + ssml_suffix
+                futures.append(executor.submit(synthesize_ssml_cached, session, ssml, cache_dir))
+            while futures:
+                outfile.write(futures.popleft().result())
+        except BaseException as e:
+            # Don't let the executor wait out the retries of the chunks
+            # still in flight
+            abort_conversion(e)
+            raise
+    os.replace(partial_file, output_file)
+
+
+def convert_chapter(session: requests.Session, idx: int, text: str, output_folder: str, voice_name: str, language: str, author: str, book_title: str, chunk_concurrency: int, cache_dir: Optional[str]) -> None:
+    # Chapters are named after the start of their text. The document <title>
+    # is usually the book title, so it can't tell chapters apart
+    title = text[:60]
+    logger.info(f"Raw title: <{title}>")
+    title = sanitize_title(title)
+    logger.info(f"Converting chapter {idx}: {title}")
+
+    output_file = os.path.join(output_folder, f"{idx:04d}_{title}.mp3")
+    text_to_speech(session, text, output_file, voice_name,
+                   language, title, author, book_title, idx, chunk_concurrency, cache_dir)
+
+
+def epub_to_audiobook(input_file: str, output_folder: str, voice_name: str, language: str, chapter_concurrency: int = 1, chunk_concurrency: int = 1, cache_dir: Optional[str] = None, tts_rps: Optional[float] = None, tts_burst: int = 1, token_refresh_margin: float = TOKEN_REFRESH_MARGIN) -> None:
+    global _token_refresh_margin, _shutdown_error
+    if not 0 <= token_refresh_margin < ACCESS_TOKEN_LIFETIME.total_seconds():
+        raise ValueError(
+            f"token_refresh_margin must be between 0 and {ACCESS_TOKEN_LIFETIME.total_seconds():.0f} seconds")
+    _token_refresh_margin = token_refresh_margin
+    if chapter_concurrency < 1:
+        raise ValueError("chapter_concurrency must be at least 1")
+    if chunk_concurrency < 1:
+        raise ValueError("chunk_concurrency must be at least 1")
+    # A zero burst never fills the bucket and a negative rate never refills
+    # it, so either would stall or crash the run partway through
+    if tts_rps is not None and tts_rps <= 0:
+        raise ValueError("tts_rps must be greater than 0")
+    if tts_burst < 1:
+        raise ValueError("tts_burst must be at least 1")
+
+    book_title, author = read_book_metadata(input_file)
+    _shutdown.clear()
+    _shutdown_error = None
 
     os.makedirs(output_folder, exist_ok=True)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
 
-    access_token = get_access_token()
-
-    # Get the book title and author from metadata or use fallback values
-    book_title = "Untitled"
-    author = "Unknown"
-    if book.get_metadata('DC', 'title'):
-        book_title = book.get_metadata('DC', 'title')[0][0]
-    if book.get_metadata('DC', 'creator'):
-        author = book.get_metadata('DC', 'creator')[0][0]
-
-    # Filter out empty or very short chapters
-    chapters = [(title, text) for title, text in chapters if text.strip()]
+    # Chapters are parsed lazily, so only the ones queued for the workers
+    # are held in memory
+    chapters = extract_chapters(input_file)
 
     with requests.Session() as session:
-        for idx, (title, text) in enumerate(chapters, start=1):
-            if not title:
-                title = text[:60]
-            logger.info(f"Raw title: <{title}>")
-            title = sanitize_title(title)
-            logger.info(f"Converting chapter {idx}/{len(chapters)}: {title}")
+        # One pooled connection per in-flight request so concurrent chunks
+        # don't discard and re-open TLS connections
+        pool_maxsize = chapter_concurrency * chunk_concurrency
+        session.mount("https://", HTTPAdapter(pool_maxsize=pool_maxsize))
+        if tts_rps is not None:
+            # Only synthesis requests count against the TTS quota
+            session.mount(TTS_URL, RateLimitedAdapter(
+                RateLimiter(tts_rps, tts_burst), pool_maxsize=pool_maxsize))
+
+        # Fetch the first token up front so that bad credentials fail fast
+        get_valid_access_token(session)
+        # Open a connection to the TTS host up front, so the first synthesis
+        # request doesn't pay for the TLS handshake. Going through TTS_URL
+        # puts it in the pool synthesis uses
+        try:
+            session.head(TTS_URL, timeout=5)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Failed to warm up connection to TTS service: {e}")
 
-            output_file = os.path.join(output_folder, f"{idx:04d}_{title}.mp3")
-            access_token = text_to_speech(session, text, output_file, voice_name,
-                                          language, access_token, title, author, book_title, idx)
+        if chapter_concurrency == 1:
+            # Convert on this thread so that Ctrl-C interrupts the chapter in
+            # progress right away
+            for idx, text in enumerate(chapters, start=1):
+                convert_chapter(session, idx, text, output_folder, voice_name,
+                                language, author, book_title, chunk_concurrency, cache_dir)
+            return
+
+        try:
+            with ThreadPoolExecutor(max_workers=chapter_concurrency) as executor:
+                futures = deque()
+                try:
+                    for idx, text in enumerate(chapters, start=1):
+                        # Don't let parsing run far ahead of synthesis
+                        if len(futures) >= chapter_concurrency * 2:
+                            futures.popleft().result()
+                        futures.append(executor.submit(convert_chapter, session, idx, text, output_folder,
+                                                       voice_name, language, author, book_title, chunk_concurrency, cache_dir))
+                    while futures:
+                        futures.popleft().result()
+                except BaseException as e:
+                    # Drop chapters that haven't started yet and make the
+                    # running ones stop at their next request, so the executor
+                    # doesn't wait for them to finish
+                    for future in futures:
+                        future.cancel()
+                    abort_conversion(e)
+                    raise
+        except CancelledError:
+            # The chapter we were waiting on was stopped because another one
+            # failed; report that failure. All workers have exited by now
+            if _shutdown_error is not None:
+                raise _shutdown_error from None
+            raise
 
 
 def main():
@@ -213,10 +519,23 @@ def main():
                         help="Voice name for the text-to-speech service (default: en-US-GuyNeural). You can use zh-CN-YunyeNeural for Chinese ebooks.")
     parser.add_argument("--language", default="en-US",
                         help="Language for the text-to-speech service (default: en-US)")
+    parser.add_argument("--chapter_concurrency", type=int, default=1,
+                        help="Number of chapters to convert in parallel (default: 1). Keep it within the concurrent request limit of your Azure pricing tier.")
+    parser.add_argument("--chunk_concurrency", type=int, default=1,
+                        help="Number of text chunks of a chapter to synthesize in parallel (default: 1). Up to chapter_concurrency * chunk_concurrency requests can be in flight.")
+    parser.add_argument("--cache_dir",
+                        help="Directory to cache synthesized audio chunks in. Reruns with the same text, voice and language reuse the cached audio instead of calling Azure again (default: disabled)")
+    parser.add_argument("--tts_rps", type=float,
+                        help="Maximum number of TTS requests per second across all workers (default: unlimited). Set it just under your Azure quota to avoid throttling when using concurrency.")
+    parser.add_argument("--tts_burst", type=int, default=1,
+                        help="Number of TTS requests that may be sent back to back before --tts_rps applies (default: 1)")
+    parser.add_argument("--token_refresh_margin", type=float, default=TOKEN_REFRESH_MARGIN,
+                        help=f"Seconds before an access token expires at which it is renewed (default: {TOKEN_REFRESH_MARGIN}). Raise it on slow connections where long chunks take a while to upload.")
     args = parser.parse_args()
 
     epub_to_audiobook(args.input_file, args.output_folder,
-                      args.voice_name, args.language)
+                      args.voice_name, args.language, args.chapter_concurrency, args.chunk_concurrency,
+                      args.cache_dir, args.tts_rps, args.tts_burst, args.token_refresh_margin)
 
 
 if __name__ == "__main__":